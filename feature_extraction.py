@@ -1,108 +1,210 @@
 import re
+import warnings
 import pandas as pd
 import ast
+import ahocorasick
+import hashlib
 import numpy as np
-from radon.raw import analyze as raw_analyze
-from radon.complexity import cc_visit
 from typing import Dict, Any
 from tqdm import tqdm
 
+# Keyword groups for semantic PR labels. All patterns are literal words, so
+# instead of a regex alternation we build one Aho-Corasick automaton per group
+# at import time: each title is scanned in a single O(len(title)) pass,
+# independent of how many keywords a group contains.
+BUGFIX_WORDS = ["fix", "fixes", "fixing", "fixed", "bug", "bugs", "error", "errors",
+                "issue", "issues", "problem", "patch", "correct", "resolve", "resolved",
+                "hotfix"]
+REFACTOR_WORDS = ["refactor", "refactored", "refactoring", "cleanup", "cleaning",
+                  "rewrite", "restructured", "modularize"]
+FEATURE_WORDS = ["add", "feature", "implement", "introduce", "create", "new",
+                 "upgrade", "enable", "improve"]
+
+
+def _build_automaton(words):
+    automaton = ahocorasick.Automaton()
+    for w in words:
+        automaton.add_word(w, w)
+    automaton.make_automaton()
+    return automaton
+
+
+BUGFIX_AC = _build_automaton(BUGFIX_WORDS)
+REFACTOR_AC = _build_automaton(REFACTOR_WORDS)
+FEATURE_AC = _build_automaton(FEATURE_WORDS)
+
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+
+def contains_keywords(text, automaton):
+    if not text:
+        return 0
+    haystack = text.lower()
+    last = len(haystack) - 1
+    for end, word in automaton.iter(haystack):
+        # Enforce \b-style word boundaries around each raw hit
+        start = end - len(word) + 1
+        if start > 0 and _is_word_char(haystack[start - 1]):
+            continue
+        if end < last and _is_word_char(haystack[end + 1]):
+            continue
+        return 1
+    return 0
+
+
+# Node-type sets for the flat AST walk below; set membership on the type
+# object replaces both NodeVisitor method dispatch and isinstance checks.
+_FUNC_NODES = {ast.FunctionDef, ast.AsyncFunctionDef}
+_LOOP_NODES = {ast.For, ast.While}
+_NESTING_NODES = {ast.If, ast.For, ast.While, ast.With, ast.Try}
+_UNIT_COMPLEXITY_NODES = {ast.If, ast.For, ast.While, ast.ExceptHandler, ast.IfExp}
+
+
+def _ast_metrics(tree):
+    """Collect structure counters and per-function McCabe complexity in one
+    flat, non-recursive pass over the tree.
+
+    An explicit stack of (node, nesting depth, enclosing-function slot)
+    avoids one Python method call per node, which dominates visitor-based
+    traversal on large files.
+    """
+    max_depth = 0
+    func_defs = 0
+    max_func_args = 0
+    total_calls = 0
+    total_if = 0
+    total_loops = 0
+    func_complexities = []
+
+    stack = [(tree, 0, -1)]
+    while stack:
+        node, depth, func_idx = stack.pop()
+        node_type = type(node)
+
+        if node_type in _FUNC_NODES:
+            # async defs get their own complexity slot and args accounting
+            # (cc_visit scored them too); func_count stays sync-only for
+            # comparability with the datasets collected before this change
+            if node_type is ast.FunctionDef:
+                func_defs += 1
+            args = node.args
+            num_args = len(args.args) + (1 if args.vararg else 0) + (1 if args.kwarg else 0)
+            max_func_args = max(max_func_args, num_args)
+            func_complexities.append(1)
+            func_idx = len(func_complexities) - 1
+        elif node_type is ast.Call:
+            total_calls += 1
+
+        if node_type in _UNIT_COMPLEXITY_NODES:
+            bump = 1
+            if node_type is ast.If:
+                total_if += 1
+            elif node_type in _LOOP_NODES:
+                total_loops += 1
+        elif node_type is ast.BoolOp:
+            bump = len(node.values) - 1
+        elif node_type is ast.comprehension:
+            bump = 1 + len(node.ifs)
+        else:
+            bump = 0
+        if bump and func_idx >= 0:
+            func_complexities[func_idx] += bump
 
-class ASTMetricsVisitor(ast.NodeVisitor):
-    def __init__(self):
-        self.max_depth = 0
-        self.current_depth = 0
-        self.func_defs = 0
-        self.max_func_args = 0
-        self.total_calls = 0
-        self.total_if = 0
-        self.total_loops = 0
-
-    def generic_visit(self, node):
-        old_depth = self.current_depth
-        if isinstance(node, (ast.If, ast.For, ast.While, ast.With, ast.Try)):
-            self.current_depth += 1
-            self.max_depth = max(self.max_depth, self.current_depth)
-        super().generic_visit(node)
-        self.current_depth = old_depth
-
-    def visit_FunctionDef(self, node):
-        self.func_defs += 1
-        num_args = len(node.args.args) + (1 if node.args.vararg else 0) + (1 if node.args.kwarg else 0)
-        self.max_func_args = max(self.max_func_args, num_args)
-        self.generic_visit(node)
-
-    def visit_Call(self, node):
-        self.total_calls += 1
-        self.generic_visit(node)
-
-    def visit_If(self, node):
-        self.total_if += 1
-        self.generic_visit(node)
+        if node_type in _NESTING_NODES:
+            depth += 1
+            if depth > max_depth:
+                max_depth = depth
 
-    def visit_For(self, node):
-        self.total_loops += 1
-        self.generic_visit(node)
+        for child in ast.iter_child_nodes(node):
+            stack.append((child, depth, func_idx))
 
-    def visit_While(self, node):
-        self.total_loops += 1
-        self.generic_visit(node)
+    return {
+        "max_depth": max_depth,
+        "func_defs": func_defs,
+        "max_func_args": max_func_args,
+        "total_calls": total_calls,
+        "total_if": total_if,
+        "total_loops": total_loops,
+        "func_complexities": func_complexities
+    }
 
 
 def compute_python_metrics(file_content: str) -> Dict[str, Any]:
+    # Line counters are shared with the non-Python path; the AST is parsed
+    # and walked exactly once for both structure and complexity metrics.
+    metrics = compute_basic_metrics(file_content)
     try:
         tree = ast.parse(file_content)
-        visitor = ASTMetricsVisitor()
-        visitor.visit(tree)
-        ast_metrics = {
-            "max_nesting": visitor.max_depth,
-            "func_count": visitor.func_defs,
-            "max_args": visitor.max_func_args,
-            "call_count": visitor.total_calls,
-            "if_count": visitor.total_if,
-            "loop_count": visitor.total_loops
-        }
+        ast_metrics = _ast_metrics(tree)
+        cc_scores = ast_metrics["func_complexities"]
+        metrics.update({
+            "max_nesting": ast_metrics["max_depth"],
+            "func_count": ast_metrics["func_defs"],
+            "max_args": ast_metrics["max_func_args"],
+            "call_count": ast_metrics["total_calls"],
+            "if_count": ast_metrics["total_if"],
+            "loop_count": ast_metrics["total_loops"],
+            "avg_cc": float(np.mean(cc_scores)) if cc_scores else None,
+            "max_cc": float(np.max(cc_scores)) if cc_scores else None
+        })
     except Exception:
-        ast_metrics = {k: None for k in ["max_nesting", "func_count", "max_args", "call_count",
-                                         "if_count", "loop_count"]}
+        pass  # keep the None defaults from compute_basic_metrics
 
-    try:
-        raw = raw_analyze(file_content)
-        loc, lloc, sloc, comments, multi, blank = raw.loc, raw.lloc, raw.sloc, raw.comments, raw.multi, raw.blank
-    except Exception:
-        loc = lloc = sloc = comments = multi = blank = None
+    return metrics
 
-    try:
-        cc_list = cc_visit(file_content)
-        cc_scores = [c.complexity for c in cc_list] if cc_list else []
-        avg_cc = float(np.mean(cc_scores)) if cc_scores else None
-        max_cc = float(np.max(cc_scores)) if cc_scores else None
-    except Exception:
-        avg_cc = max_cc = None
 
-    return {**ast_metrics,
-            "avg_cc": avg_cc,
-            "max_cc": max_cc,
-            "loc": loc,
-            "lloc": lloc,
-            "sloc": sloc,
-            "comments": comments,
-            "multi_comments": multi,
-            "blank": blank}
+# Line classification done with C-level bulk operations instead of a Python
+# loop per line. [^\S\n]* is any whitespace except \n — including the \r of
+# CRLF line endings — without letting a match cross into the next line.
+_BLANK_LINE_RE = re.compile(r'(?m)^[^\S\n]*$')
+_COMMENT_LINE_RE = re.compile(r'(?m)^[^\S\n]*(?:#|//|/\*|\*)')
 
 
 def compute_basic_metrics(content: str) -> Dict[str, Any]:
-    lines = content.splitlines()
-    loc = len(lines)
-    blank = sum(1 for l in lines if not l.strip())
-    comments = sum(1 for l in lines if l.strip().startswith(("#", "//", "/*", "*")))
+    if content:
+        loc = content.count('\n') + (0 if content.endswith('\n') else 1)
+        # the blank pattern also matches the empty position after a trailing
+        # newline, which splitlines() would not count as a line
+        blank = len(_BLANK_LINE_RE.findall(content)) - (1 if content.endswith('\n') else 0)
+        comments = len(_COMMENT_LINE_RE.findall(content))
+    else:
+        loc = blank = comments = 0
     sloc = loc - blank - comments
-    return {"loc": loc, "sloc": sloc, "blank": blank, "comments": comments, "multi_comments": None,
+    return {"loc": loc, "lloc": None, "sloc": sloc, "blank": blank, "comments": comments,
+            "multi_comments": None,
             "max_nesting": None, "func_count": None, "max_args": None, "call_count": None, "if_count": None,
             "loop_count": None,
             "avg_cc": None, "max_cc": None}
 
 
+# Metrics are deterministic on file content, and identical blobs recur often
+# across PRs of the same repo — cache by content digest so duplicates skip
+# the parse entirely. Bounded by a simple clear-on-full policy.
+_metrics_cache: Dict[Any, Dict[str, Any]] = {}
+_METRICS_CACHE_MAX = 16384
+
+
+def compute_file_metrics(filename: str, content: str) -> Dict[str, Any]:
+    """Dispatch to the Python or basic metrics for a single file.
+
+    Module-level so it can be shipped to a ProcessPoolExecutor worker.
+    """
+    is_python = filename.endswith(".py")
+    key = (is_python, hashlib.blake2b(content.encode("utf-8", "replace"), digest_size=16).digest())
+    cached = _metrics_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+
+    metrics = compute_python_metrics(content) if is_python else compute_basic_metrics(content)
+
+    if len(_metrics_cache) >= _METRICS_CACHE_MAX:
+        _metrics_cache.clear()
+    _metrics_cache[key] = metrics
+    return dict(metrics)
+
+
 def aggregate_file_metrics(pr: Dict[str, Any]) -> Dict[str, Any]:
     keys = ["max_nesting", "func_count", "max_args", "call_count", "if_count", "loop_count",
             "avg_cc", "max_cc", "loc", "lloc", "sloc", "comments", "multi_comments", "blank"]
@@ -110,81 +212,83 @@ def aggregate_file_metrics(pr: Dict[str, Any]) -> Dict[str, Any]:
     agg = {}
     files_metrics = pr.get("files_metrics", []) or []
 
-    for key in keys:
-        values = [f.get(key) for f in files_metrics if f.get(key) is not None]
-        if values:
-            agg[f"min_{key}"] = min(values)
-            agg[f"avg_{key}"] = float(np.mean(values))
-            agg[f"max_{key}"] = max(values)
+    if not files_metrics:
+        for key in keys:
+            agg[f"min_{key}"] = agg[f"avg_{key}"] = agg[f"max_{key}"] = None
+        return agg
+
+    # One (files x metrics) array; None becomes NaN, so a single set of
+    # nan-reductions along axis 0 replaces 14 x 3 Python-level passes.
+    matrix = np.array([[f.get(key) for key in keys] for f in files_metrics],
+                      dtype=np.float64)
+    with warnings.catch_warnings():
+        # all-NaN columns (metric absent for every file) are expected
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mins = np.nanmin(matrix, axis=0)
+        avgs = np.nanmean(matrix, axis=0)
+        maxs = np.nanmax(matrix, axis=0)
+    has_values = ~np.all(np.isnan(matrix), axis=0)
+
+    for i, key in enumerate(keys):
+        if has_values[i]:
+            agg[f"min_{key}"] = float(mins[i])
+            agg[f"avg_{key}"] = float(avgs[i])
+            agg[f"max_{key}"] = float(maxs[i])
         else:
             agg[f"min_{key}"] = agg[f"avg_{key}"] = agg[f"max_{key}"] = None
 
     return agg
 
 
+def build_pr_row(pr: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn one fetched PR dict into a flat feature row (mutates pr in place)."""
+    files_metrics = pr.get("files_metrics", [])
+
+    # Process files that have content
+    files_with_content = 0
+    for f in files_metrics:
+        fname = f.get("filename", "")
+        content = f.get("content", "")
+        if not content:
+            continue  # skip empty files but continue processing PR
+
+        files_with_content += 1
+        # Skip files whose metrics were already computed upstream
+        # (e.g. fanned out to a process pool by the caller)
+        if "loc" not in f:
+            f.update(compute_file_metrics(fname, content))
+
+    # Aggregate metrics (even if no files had content) ---
+    agg_metrics = aggregate_file_metrics(pr)
+    pr.update(agg_metrics)
+
+    # PR-level features (title/body bound once instead of repeated dict lookups)
+    title = pr.get("title") or ""
+    body = pr.get("body") or ""
+    pr["title_length"] = len(title) if title else None
+    pr["description_length"] = len(body) if body else None
+    pr["files_with_content"] = files_with_content  # Track how many files had content
+
+    # Semantic labels via multi-pattern keyword matching
+    pr["is_bugfix"] = contains_keywords(title, BUGFIX_AC)
+    pr["is_refactor"] = contains_keywords(title, REFACTOR_AC)
+    pr["is_feature"] = contains_keywords(title, FEATURE_AC)
+
+    # Remove raw body
+    pr.pop("body", None)
+
+    return pr
+
+
 def build_initial_pr_dataframe(pr_list):
     df_rows = []
 
     for pr in tqdm(pr_list, desc="Building dataframe for PRs", unit="PR"):
-        files_metrics = pr.get("files_metrics", [])
-
-        # Process files that have content
-        files_with_content = 0
-        for f in files_metrics:
-            fname = f.get("filename", "")
-            content = f.get("content", "")
-            if not content:
-                continue  # skip empty files but continue processing PR
-
-            files_with_content += 1
-            if fname.endswith(".py"):
-                f.update(compute_python_metrics(content))
-            else:
-                f.update(compute_basic_metrics(content))
-
-        # Aggregate metrics (even if no files had content) ---
-        agg_metrics = aggregate_file_metrics(pr)
-        pr.update(agg_metrics)
-
-        # PR-level features
-        pr["title_length"] = len(pr.get("title", "")) if pr.get("title") else None
-        pr["description_length"] = len(pr.get("body", "")) if pr.get("body") else None
-        pr["files_with_content"] = files_with_content  # Track how many files had content
-
-        # Semantic labels using regex
-        def contains_keywords_regex(text, patterns):
-            if not text:
-                return 0
-            text_lower = text.lower()
-            return int(any(re.search(p, text_lower) for p in patterns))
-
-        bugfix_patterns = [r'\bfix\b', r'\bbug\b', r'\berror\b', r'\bissue\b',
-                           r'\bfixes\b', r'\bbugs\b', r'\berrors\b', r'\bissues\b',
-                           r'\bfixing\b', r'\bfixed\b', r'\bproblem\b', r'\bpatch\b',
-                           r'\bcorrect\b', r'\bresolve\b', r'\bresolved\b', r'\bhotfix\b']
-        refactor_patterns = [r'\brefactor\b', r'\bcleanup\b', r'\brefactored\b', r'\bcleaning\b',
-                             r'\brefactoring\b', r'\brewrite\b', r'\brestructured\b', r'\bmodularize\b']
-        feature_patterns = [r'\badd\b', r'\bfeature\b', r'\bimplement\b', r'\bintroduce\b',
-                            r'\bcreate\b', r'\bnew\b', r'\bupgrade\b', r'\benable\b', r'\bimprove\b']
-
-        pr["is_bugfix"] = contains_keywords_regex(pr.get("title", ""), bugfix_patterns)
-        pr["is_refactor"] = contains_keywords_regex(pr.get("title", ""), refactor_patterns)
-        pr["is_feature"] = contains_keywords_regex(pr.get("title", ""), feature_patterns)
-
-        # Remove raw body
-        pr.pop("body", None)
-
         # Always append the PR, even if no files had content
-        df_rows.append(pr)
-
-    # Ensure consistent columns
-    all_keys = set().union(*[pr.keys() for pr in df_rows])
-    for pr in df_rows:
-        for k in all_keys:
-            if k not in pr:
-                pr[k] = None
+        df_rows.append(build_pr_row(pr))
 
-    df = pd.DataFrame(df_rows)
+    # from_records already unions the keys and fills missing ones with NaN
+    df = pd.DataFrame.from_records(df_rows)
 
     print(f"[INFO] build_initial_pr_dataframe: Input {len(pr_list)} PRs → Output {len(df)} rows")
 
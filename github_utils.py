@@ -1,6 +1,10 @@
+import json
 import time
+import requests
 from github import Github, RateLimitExceededException, GithubException
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from tqdm import tqdm
 from config import GITHUB_TOKEN1, GITHUB_TOKEN2, GITHUB_TOKEN3, GITHUB_TOKEN4, GITHUB_TOKEN5
 
@@ -10,37 +14,80 @@ g3 = Github(GITHUB_TOKEN3) if GITHUB_TOKEN3 else Github()
 g4 = Github(GITHUB_TOKEN4) if GITHUB_TOKEN4 else Github()
 g5 = Github(GITHUB_TOKEN5) if GITHUB_TOKEN5 else Github()
 
-TOKENS = [g5]
-token_index = 0
+# All five clients participate; per-token budgets are tracked so calls go to
+# the token with the most remaining quota and we only sleep once every token
+# is exhausted at the same time.
+TOKENS = [g1, g2, g3, g4, g5]
+token_remaining = [5000] * len(TOKENS)
+token_reset_at = [0] * len(TOKENS)
+token_lock = Lock()
 author_pr_cache = defaultdict(list)
 
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_TOKENS = [t for t in [GITHUB_TOKEN1, GITHUB_TOKEN2, GITHUB_TOKEN3,
+                              GITHUB_TOKEN4, GITHUB_TOKEN5] if t]
+graphql_remaining = [5000] * len(GRAPHQL_TOKENS)
+graphql_reset_at = [0] * len(GRAPHQL_TOKENS)
+
+
+def _acquire_token_index(remaining, reset_at):
+    """Index of the token with the most budget; sleeps only when all are out."""
+    while True:
+        with token_lock:
+            now = int(time.time())
+            for i in range(len(remaining)):
+                if remaining[i] <= 10 and reset_at[i] <= now:
+                    remaining[i] = 5000  # budget refreshed at reset time
+            idx = max(range(len(remaining)), key=lambda i: remaining[i])
+            if remaining[idx] > 10:
+                return idx
+            wait = max(min(reset_at) - now, 5)
+        print(f"\n[RATE LIMIT] All tokens exhausted. Waiting {wait} seconds...")
+        time.sleep(wait)
+
+
+def _mark_token_exhausted(remaining, reset_at, idx, reset):
+    with token_lock:
+        remaining[idx] = 0
+        if reset > 0:
+            reset_at[idx] = reset
+
 
 def _get_client():
-    global token_index
-    client = TOKENS[token_index]
-    token_index = (token_index + 1) % len(TOKENS)
-    return client
+    idx = _acquire_token_index(token_remaining, token_reset_at)
+    return TOKENS[idx], idx
+
+
+def _update_token_budget(idx, client):
+    try:
+        remaining, _ = client.rate_limiting
+        reset = client.rate_limiting_resettime
+        with token_lock:
+            token_remaining[idx] = remaining
+            if reset:
+                token_reset_at[idx] = reset
+    except Exception:
+        pass
 
 
 def _safe_github_call(func, *args, **kwargs):
     while True:
-        client = _get_client()
+        client, idx = _get_client()
         try:
-            return func(client, *args, **kwargs)
+            result = func(client, *args, **kwargs)
+            _update_token_budget(idx, client)
+            return result
 
         except RateLimitExceededException as e:
             reset = int(e.headers.get("X-RateLimit-Reset", 0))
-            wait = max(reset - int(time.time()), 5)
-            print(f"\n[RATE LIMIT] Token exhausted. Waiting {wait} seconds...")
-            time.sleep(wait)
+            _mark_token_exhausted(token_remaining, token_reset_at, idx, reset)
+            # retry immediately on the next-best token
 
         except GithubException as e:
             if e.status == 403:
                 reset = int(e.headers.get("X-RateLimit-Reset", 0))
                 if reset > 0:
-                    wait = max(reset - int(time.time()), 5)
-                    print(f"\n[RATE LIMIT] 403 with reset header. Waiting {wait} seconds...")
-                    time.sleep(wait)
+                    _mark_token_exhausted(token_remaining, token_reset_at, idx, reset)
                     continue
             raise e
 
@@ -50,105 +97,265 @@ def _safe_github_call(func, *args, **kwargs):
 
 def fetch_pr_list(repo_full_name, max_prs=1000, state="closed", skip=0):
     repo = _safe_github_call(lambda c, repo: c.get_repo(repo), repo_full_name)
-    pulls = repo.get_pulls(state=state, sort="created", direction="desc")
+
+    # PaginatedList fetches pages lazily while iterating; number/merged_at
+    # come straight from the list payload, so no per-PR follow-up fetch.
+    # A PaginatedList iterator that raised cannot be resumed, so after a
+    # rate-limit sleep it is rebuilt and fast-forwarded past what was seen.
+    def _make_iterator(offset):
+        pulls = repo.get_pulls(state=state, sort="created", direction="desc")
+        return iter(pulls[offset:] if offset else pulls)
+
     all_prs = []
-    items_per_page = 100
-    start_page = skip // items_per_page
-    skip_in_page = skip % items_per_page
-    page = start_page
-    skipped = 0
+    consumed = 0
     pbar = tqdm(total=max_prs, desc=f"Fetching closed PRs", unit="PR")
 
+    iterator = _make_iterator(skip)
     while len(all_prs) < max_prs:
-        page_items = _safe_github_call(lambda c, pulls, p: pulls.get_page(p), pulls, page)
-        if not page_items:
+        try:
+            pr = next(iterator)
+
+        except StopIteration:
             break
 
-        for pr in page_items:
-            if page == start_page and skipped < skip_in_page:
-                skipped += 1
-                continue
+        except RateLimitExceededException as e:
+            reset = int((e.headers or {}).get("X-RateLimit-Reset", 0))
+            wait = max(reset - int(time.time()), 5)
+            print(f"\n[RATE LIMIT] While listing PRs. Waiting {wait} seconds...")
+            time.sleep(wait)
+            iterator = _make_iterator(skip + consumed)
+            continue
 
-            # Keep only closed unmerged PRs
-            if pr.merged_at is not None:
-                continue
+        except GithubException as e:
+            if e.status == 403:
+                reset = int((e.headers or {}).get("X-RateLimit-Reset", 0))
+                if reset > 0:
+                    wait = max(reset - int(time.time()), 5)
+                    print(f"\n[RATE LIMIT] 403 while listing PRs. Waiting {wait} seconds...")
+                    time.sleep(wait)
+                    iterator = _make_iterator(skip + consumed)
+                    continue
+            raise e
+
+        consumed += 1
 
-            all_prs.append(pr)
-            pbar.update(1)
-            if len(all_prs) >= max_prs:
-                break
+        # Keep only closed unmerged PRs
+        if pr.merged_at is not None:
+            continue
 
-        page += 1
+        all_prs.append(pr)
+        pbar.update(1)
 
     pbar.close()
     print(f"[INFO] Retrieved {len(all_prs)} closed-unmerged PRs")
     return all_prs
 
 
+def _graphql_request(query, variables=None):
+    backoff = 2
+    while True:
+        if GRAPHQL_TOKENS:
+            idx = _acquire_token_index(graphql_remaining, graphql_reset_at)
+            headers = {"Authorization": f"bearer {GRAPHQL_TOKENS[idx]}"}
+        else:
+            idx = None
+            headers = {}
+        try:
+            resp = requests.post(GRAPHQL_URL,
+                                 json={"query": query, "variables": variables or {}},
+                                 headers=headers, timeout=60)
+        except requests.RequestException:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+
+        reset = int(resp.headers.get("X-RateLimit-Reset", 0))
+        if idx is not None:
+            with token_lock:
+                graphql_remaining[idx] = int(resp.headers.get("X-RateLimit-Remaining",
+                                                              graphql_remaining[idx]))
+                if reset > 0:
+                    graphql_reset_at[idx] = reset
+
+        # 502/504s are routine on heavy GraphQL queries — transient, retry
+        if resp.status_code >= 500:
+            print(f"\n[WARNING] GraphQL server error {resp.status_code}. "
+                  f"Retrying in {backoff} seconds...")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+
+        if resp.status_code in (403, 429):
+            payload = {}
+        else:
+            try:
+                payload = resp.json()
+            except ValueError:
+                # non-JSON body (e.g. an HTML error page) — treat as transient
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+        errors = payload.get("errors") or []
+        rate_limited = (resp.status_code in (403, 429)
+                        or any(e.get("type") == "RATE_LIMITED" for e in errors))
+        if rate_limited:
+            if idx is not None:
+                _mark_token_exhausted(graphql_remaining, graphql_reset_at, idx, reset)
+                continue  # retry immediately on the next-best token
+            wait = max(reset - int(time.time()), 5)
+            print(f"\n[RATE LIMIT] GraphQL rate limited. Waiting {wait} seconds...")
+            time.sleep(wait)
+            continue
+
+        if errors and payload.get("data") is None:
+            raise RuntimeError(f"GraphQL query failed: {errors}")
+
+        return payload.get("data") or {}
+
+
+# One query fetches everything the old REST path needed ~4 round-trips for:
+# PR metadata, issue comments, commits and the changed-file list.
+_PR_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      number
+      title
+      body
+      createdAt
+      closedAt
+      mergedAt
+      additions
+      deletions
+      changedFiles
+      headRefOid
+      author { login }
+      comments(first: 100) {
+        nodes { author { login } createdAt }
+      }
+      commits(first: 250) {
+        totalCount
+        nodes { commit { oid author { user { login } } committer { date } } }
+      }
+      files(first: 100) {
+        nodes { path }
+      }
+    }
+  }
+}
+"""
+
+
+# Aliased blob fields per GraphQL query; file-heavy PRs are split into
+# chunks fetched concurrently instead of one oversized request.
+BLOB_CHUNK_SIZE = 50
+BLOB_FETCH_WORKERS = 8
+
+
+def _fetch_blob_chunk(owner, name, ref_oid, paths):
+    """Fetch the decoded text of a chunk of blobs in one aliased GraphQL query."""
+    parts = []
+    for i, path in enumerate(paths):
+        expression = json.dumps(f"{ref_oid}:{path}")
+        parts.append(f"f{i}: object(expression: {expression}) {{ ... on Blob {{ oid text isBinary }} }}")
+    query = "query { repository(owner: %s, name: %s) { %s } }" % (
+        json.dumps(owner), json.dumps(name), " ".join(parts))
+
+    repository = _graphql_request(query).get("repository") or {}
+    contents = {}
+    for i, path in enumerate(paths):
+        blob = repository.get(f"f{i}") or {}
+        # text arrives UTF-8 decoded already (no base64 round-trip as with
+        # the REST contents API); binary blobs have no usable text
+        contents[path] = {
+            "content": None if blob.get("isBinary") else blob.get("text"),
+            "sha": blob.get("oid")
+        }
+    return contents
+
+
+def _fetch_blob_texts(owner, name, ref_oid, paths):
+    chunks = [paths[i:i + BLOB_CHUNK_SIZE] for i in range(0, len(paths), BLOB_CHUNK_SIZE)]
+    if len(chunks) <= 1:
+        return _fetch_blob_chunk(owner, name, ref_oid, paths) if paths else {}
+
+    contents = {}
+    with ThreadPoolExecutor(max_workers=BLOB_FETCH_WORKERS) as executor:
+        for chunk_contents in executor.map(
+                lambda chunk: _fetch_blob_chunk(owner, name, ref_oid, chunk), chunks):
+            contents.update(chunk_contents)
+    return contents
+
+
 def fetch_single_pr(repo_full_name, pr_number):
-    repo = _safe_github_call(lambda c, name: c.get_repo(name), repo_full_name)
-    pr = _safe_github_call(lambda c, r, num: r.get_pull(num), repo, pr_number)
+    owner, name = repo_full_name.split("/", 1)
+    data = _graphql_request(_PR_QUERY, {"owner": owner, "name": name, "number": pr_number})
+    pr = (data.get("repository") or {}).get("pullRequest")
+    if pr is None:
+        raise RuntimeError(f"PR #{pr_number} not found in {repo_full_name}")
 
     pr_dict = {
-        "number": pr.number,
-        "title": pr.title or None,
-        "body": pr.body or None,
-        "created_at": pr.created_at.isoformat() if pr.created_at else None,
-        "closed_at": pr.closed_at.isoformat() if pr.closed_at else None,
-        "merged_at": pr.merged_at.isoformat() if pr.merged_at else None,
-        "additions": pr.additions or -1,
-        "deletions": pr.deletions or -1,
-        "changed_files": pr.changed_files or -1,
-        "commits": pr.commits or -1,
-        "author": pr.user.login if pr.user else None
+        "number": pr["number"],
+        "title": pr.get("title") or None,
+        "body": pr.get("body") or None,
+        "created_at": pr.get("createdAt"),
+        "closed_at": pr.get("closedAt"),
+        "merged_at": pr.get("mergedAt"),
+        "additions": pr.get("additions") or -1,
+        "deletions": pr.get("deletions") or -1,
+        "changed_files": pr.get("changedFiles") or -1,
+        "commits": (pr.get("commits") or {}).get("totalCount") or -1,
+        "author": (pr.get("author") or {}).get("login")
     }
 
     # Comments
     try:
-        comments = _safe_github_call(lambda c, pr: list(pr.get_issue_comments()), pr)
+        comment_nodes = (pr.get("comments") or {}).get("nodes") or []
         pr_dict["comments_list"] = [
             {
-                "user": c.user.login if c.user else None,
-                "created_at": c.created_at.isoformat() if c.created_at else None
+                "user": (c.get("author") or {}).get("login"),
+                "created_at": c.get("createdAt")
             }
-            for c in comments
+            for c in comment_nodes
         ]
-        pr_dict["reviewers_list"] = list({c.user.login for c in comments if c.user})
+        pr_dict["reviewers_list"] = list({c["user"] for c in pr_dict["comments_list"] if c["user"]})
     except Exception:
         pr_dict["comments_list"] = []
         pr_dict["reviewers_list"] = []
 
-    # Commits
+    # Commits (fetched once in the PR query; also reused below for the blob ref)
+    commit_nodes = (pr.get("commits") or {}).get("nodes") or []
     try:
-        commits = _safe_github_call(lambda c, pr: list(pr.get_commits()), pr)
         pr_dict["commits_list"] = [
             {
-                "author": c.author.login if c.author else None,
-                "timestamp": c.commit.committer.date.isoformat()
-                if c.commit and c.commit.committer else None
+                "author": (((c.get("commit") or {}).get("author") or {}).get("user") or {}).get("login"),
+                "timestamp": ((c.get("commit") or {}).get("committer") or {}).get("date")
             }
-            for c in commits
+            for c in commit_nodes
         ]
     except Exception:
         pr_dict["commits_list"] = None
 
-    # Files + full contents
+    # Files + full contents (Python files only — blob downloads for PRs
+    # without any .py file would be wasted, the main loop skips them anyway)
     pr_dict["files_metrics"] = []
     try:
-        commits = _safe_github_call(lambda c, pr: list(pr.get_commits()), pr)
-        last_sha = commits[-1].sha if commits else pr.head.sha
-        files = _safe_github_call(lambda c, pr: list(pr.get_files()), pr)
-        for f in files:
-            try:
-                content_file = _safe_github_call(
-                    lambda c, repo, filename, ref: repo.get_contents(filename, ref=ref),
-                    repo, f.filename, last_sha
-                )
-                content = content_file.decoded_content.decode("utf-8")
-            except Exception:
-                content = None
-
-            pr_dict["files_metrics"].append({"filename": f.filename, "content": content})
+        file_nodes = (pr.get("files") or {}).get("nodes") or []
+        py_paths = [f.get("path") for f in file_nodes
+                    if f.get("path") and f["path"].endswith(".py")]
+        if not py_paths:
+            return pr_dict
+
+        # Same ref the old REST path used: the last commit of the PR,
+        # falling back to the head ref
+        last_commit = (commit_nodes[-1].get("commit") or {}) if commit_nodes else {}
+        ref_oid = last_commit.get("oid") or pr.get("headRefOid")
+        contents = _fetch_blob_texts(owner, name, ref_oid, py_paths)
+        for path in py_paths:
+            blob = contents.get(path) or {}
+            pr_dict["files_metrics"].append({"filename": path,
+                                             "content": blob.get("content"),
+                                             "sha": blob.get("sha")})
 
     except Exception:
         pr_dict["files_metrics"] = None
@@ -1,13 +1,17 @@
 import os
 import sys
 import json
-import pandas as pd
+import shelve
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from github import RateLimitExceededException, GithubException
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from threading import Lock
 
 from github_utils import fetch_single_pr, _safe_github_call
-from feature_extraction import build_initial_pr_dataframe
+from feature_extraction import build_pr_row, compute_file_metrics
 from config import REPOS, OUTPUT_DIR
 
 if not os.path.exists(OUTPUT_DIR):
@@ -27,44 +31,156 @@ COLUMNS = [
     "description_length", "files_with_content", "is_bugfix", "is_refactor", "is_feature"
 ]
 
+# Parquet schema for the batch files: nested structures stay native list/struct
+# columns instead of being string-escaped into CSV cells.
+_FILE_METRIC_KEYS = ["max_nesting", "func_count", "max_args", "call_count", "if_count",
+                     "loop_count", "avg_cc", "max_cc", "loc", "lloc", "sloc", "comments",
+                     "multi_comments", "blank"]
+
+_COLUMN_TYPES = {
+    "number": pa.int64(),
+    "title": pa.string(),
+    "created_at": pa.string(),
+    "closed_at": pa.string(),
+    "merged_at": pa.string(),
+    "additions": pa.int64(),
+    "deletions": pa.int64(),
+    "changed_files": pa.int64(),
+    "commits": pa.int64(),
+    "author": pa.string(),
+    "comments_list": pa.list_(pa.struct([("user", pa.string()),
+                                         ("created_at", pa.string())])),
+    "reviewers_list": pa.list_(pa.string()),
+    "commits_list": pa.list_(pa.struct([("author", pa.string()),
+                                        ("timestamp", pa.string())])),
+    "files_metrics": pa.list_(pa.struct(
+        [("filename", pa.string()), ("sha", pa.string()), ("content", pa.string())]
+        + [(k, pa.float64()) for k in _FILE_METRIC_KEYS])),
+    "title_length": pa.int64(),
+    "description_length": pa.int64(),
+    "files_with_content": pa.int64(),
+    "is_bugfix": pa.int64(),
+    "is_refactor": pa.int64(),
+    "is_feature": pa.int64()
+}
+
+# everything else is a min_/avg_/max_ aggregate
+SCHEMA = pa.schema([(col, _COLUMN_TYPES.get(col, pa.float64())) for col in COLUMNS])
+
 TARGET_PRS_WITH_PYTHON = 2500
 FETCH_BATCH_SIZE = 200
 SAVE_EVERY = 25
 MAX_WORKERS = 10
 
-csv_lock = Lock()
+write_lock = Lock()
+
+_metrics_executor = None
+
+
+def _get_metrics_executor():
+    """Process pool for the CPU-bound AST/metrics work (created on first use)."""
+    global _metrics_executor
+    if _metrics_executor is None:
+        _metrics_executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _metrics_executor
+
+
+def _compute_batch_file_metrics(df_rows):
+    """Fan per-file metric computation out across processes.
+
+    Files are independent of each other, so the AST/complexity passes are
+    computed in parallel here and scattered back into each PR's
+    files_metrics; build_initial_pr_dataframe then only does the cheap
+    aggregation/labeling pass.
+
+    Results are persisted in a shelve keyed by the blob SHA the API
+    reports, so re-runs (incremental batching via metadata.json) skip all
+    metric work for blobs already seen.
+    """
+    cache = shelve.open(os.path.join(OUTPUT_DIR, "metrics.cache"))
+    try:
+        pending = []
+        for pr in df_rows:
+            for f in pr.get("files_metrics") or []:
+                if not f.get("content") or "loc" in f:
+                    continue
+                sha = f.get("sha")
+                if sha and sha in cache:
+                    f.update(cache[sha])
+                    continue
+                pending.append(f)
+
+        if not pending:
+            return
+
+        executor = _get_metrics_executor()
+        results = executor.map(compute_file_metrics,
+                               [f["filename"] for f in pending],
+                               [f["content"] for f in pending],
+                               chunksize=16)
+        for f, metrics in zip(pending, results):
+            f.update(metrics)
+            if f.get("sha"):
+                cache[f["sha"]] = metrics
+    finally:
+        cache.close()
 
 
 def fetch_pr_list_descending(repo_full_name, max_pr_number=None, max_prs=1000):
     repo = _safe_github_call(lambda c, name: c.get_repo(name), repo_full_name)
-    pulls = repo.get_pulls(state="closed", sort="created", direction="desc")
+
+    # Iterate the PaginatedList lazily; number/merged_at are part of the list
+    # payload so no per-PR follow-up fetch is triggered. An iterator that
+    # raised cannot be resumed, so after a rate-limit sleep it is rebuilt
+    # and fast-forwarded past what was already seen.
+    def _make_iterator(offset):
+        pulls = repo.get_pulls(state="closed", sort="created", direction="desc")
+        return iter(pulls[offset:] if offset else pulls)
 
     all_prs = []
-    page = 0
+    consumed = 0
 
     pbar = tqdm(total=max_prs, desc=f"Fetching PRs below #{max_pr_number if max_pr_number else 'latest'}", unit="PR")
 
+    iterator = _make_iterator(0)
     while len(all_prs) < max_prs:
-        page_items = _safe_github_call(lambda c, pulls, p: pulls.get_page(p), pulls, page)
-        if not page_items:
-            break
+        try:
+            pr = next(iterator)
 
-        for pr in page_items:
-            # Skip already processed PRs
-            if max_pr_number is not None and pr.number >= max_pr_number:
-                continue
+        except StopIteration:
+            break
 
-            # Skip merged PRs
-            if pr.merged_at is not None:
-                continue
+        except RateLimitExceededException as e:
+            reset = int((e.headers or {}).get("X-RateLimit-Reset", 0))
+            wait = max(reset - int(time.time()), 5)
+            print(f"\n[RATE LIMIT] While listing PRs. Waiting {wait} seconds...")
+            time.sleep(wait)
+            iterator = _make_iterator(consumed)
+            continue
 
-            all_prs.append(pr)
-            pbar.update(1)
+        except GithubException as e:
+            if e.status == 403:
+                reset = int((e.headers or {}).get("X-RateLimit-Reset", 0))
+                if reset > 0:
+                    wait = max(reset - int(time.time()), 5)
+                    print(f"\n[RATE LIMIT] 403 while listing PRs. Waiting {wait} seconds...")
+                    time.sleep(wait)
+                    iterator = _make_iterator(consumed)
+                    continue
+            raise e
+
+        consumed += 1
+
+        # Skip already processed PRs
+        if max_pr_number is not None and pr.number >= max_pr_number:
+            continue
 
-            if len(all_prs) >= max_prs:
-                break
+        # Skip merged PRs
+        if pr.merged_at is not None:
+            continue
 
-        page += 1
+        all_prs.append(pr)
+        pbar.update(1)
 
     pbar.close()
     print(f"[INFO] Retrieved {len(all_prs)} closed-unmerged PRs")
@@ -83,12 +199,14 @@ def process_repository(repo_name: str):
     metadata_file = os.path.join(repo_dir, "metadata.json")
 
     metadata = _load_metadata(metadata_file)
-    existing_pr_numbers = set(metadata.get('processed_pr_numbers', []))
+    existing_pr_numbers = _expand_pr_ranges(metadata.get('processed_pr_ranges', []))
+    # legacy metadata files stored the numbers as a flat list
+    existing_pr_numbers.update(metadata.get('processed_pr_numbers', []))
     processed_with_python = metadata.get('processed_with_python', 0)
     csv_file_counter = metadata.get('csv_file_counter', 0)
     lowest_pr_number = metadata.get('lowest_pr_number', None)
 
-    print(f"[INFO] Starting from CSV file #{csv_file_counter + 1}")
+    print(f"[INFO] Starting from batch file #{csv_file_counter + 1}")
     print(f"[INFO] Progress: {processed_with_python}/{TARGET_PRS_WITH_PYTHON}")
     if lowest_pr_number:
         print(f"[INFO] Will fetch PRs below #{lowest_pr_number}")
@@ -146,10 +264,10 @@ def process_repository(repo_name: str):
                         # Save batch when threshold reached
                         if len(df_rows) >= SAVE_EVERY:
                             csv_file_counter += 1
-                            csv_filename = f"{repo_name.replace('/', '_')}_initial_{csv_file_counter}.csv"
-                            csv_path = os.path.join(repo_dir, csv_filename)
+                            batch_filename = f"{repo_name.replace('/', '_')}_initial_{csv_file_counter}.parquet"
+                            batch_path = os.path.join(repo_dir, batch_filename)
 
-                            rows_saved = _save_batch_to_separate_csv(csv_path, df_rows)
+                            rows_saved = _save_batch_to_separate_parquet(batch_path, df_rows)
 
                             if rows_saved > 0:
                                 # Update lowest_pr_number from current batch
@@ -158,12 +276,12 @@ def process_repository(repo_name: str):
 
                                 # Save metadata
                                 _save_metadata(metadata_file, {
-                                    'processed_pr_numbers': list(existing_pr_numbers),
+                                    'processed_pr_ranges': _compress_pr_numbers(existing_pr_numbers),
                                     'processed_with_python': processed_with_python,
                                     'csv_file_counter': csv_file_counter,
                                     'lowest_pr_number': lowest_pr_number
                                 })
-                                print(f"✓ Saved {csv_filename} | Progress: {processed_with_python}/{TARGET_PRS_WITH_PYTHON}")
+                                print(f"✓ Saved {batch_filename} | Progress: {processed_with_python}/{TARGET_PRS_WITH_PYTHON}")
                                 df_rows = []
                             else:
                                 print(f"[ERROR] Save failed - NOT clearing buffer!")
@@ -177,21 +295,21 @@ def process_repository(repo_name: str):
         # Save remaining rows if we have any
         if df_rows and processed_with_python < TARGET_PRS_WITH_PYTHON:
             csv_file_counter += 1
-            csv_filename = f"{repo_name.replace('/', '_')}_initial_{csv_file_counter}.csv"
-            csv_path = os.path.join(repo_dir, csv_filename)
+            batch_filename = f"{repo_name.replace('/', '_')}_initial_{csv_file_counter}.parquet"
+            batch_path = os.path.join(repo_dir, batch_filename)
 
-            rows_saved = _save_batch_to_separate_csv(csv_path, df_rows)
+            rows_saved = _save_batch_to_separate_parquet(batch_path, df_rows)
             if rows_saved > 0:
                 pr_numbers_in_batch = [pr['number'] for pr in df_rows]
                 lowest_pr_number = min(pr_numbers_in_batch)
 
                 _save_metadata(metadata_file, {
-                    'processed_pr_numbers': list(existing_pr_numbers),
+                    'processed_pr_ranges': _compress_pr_numbers(existing_pr_numbers),
                     'processed_with_python': processed_with_python,
                     'csv_file_counter': csv_file_counter,
                     'lowest_pr_number': lowest_pr_number
                 })
-                print(f"✓ Saved {csv_filename} (final partial batch)")
+                print(f"✓ Saved {batch_filename} (final partial batch)")
                 df_rows = []
 
         # Update lowest_pr_number for next iteration
@@ -205,58 +323,46 @@ def process_repository(repo_name: str):
 
     print(f"\n{'=' * 60}")
     print(f"✓ FINISHED {repo_name}")
-    print(f"Total CSV files created: {csv_file_counter}")
+    print(f"Total batch files created: {csv_file_counter}")
     print(f"Total with Python: {processed_with_python}")
     print(f"Skipped (no Python): {skipped_no_python}")
     print(f"{'=' * 60}")
 
 
-def _save_batch_to_separate_csv(csv_path, df_rows):
+def _save_batch_to_separate_parquet(parquet_path, df_rows):
     if not df_rows:
         return 0
 
     try:
-        print(f"\n[SAVE] Creating new CSV with {len(df_rows)} PRs...")
+        print(f"\n[SAVE] Creating new Parquet file with {len(df_rows)} PRs...")
 
-        # Build dataframe
+        # Compute per-file metrics in parallel, then build the flat rows
         try:
-            batch_df = build_initial_pr_dataframe(df_rows)
+            _compute_batch_file_metrics(df_rows)
+            rows = [build_pr_row(pr) for pr in df_rows]
         except Exception as e:
-            print(f"[ERROR] build_initial_pr_dataframe crashed: {e}")
+            print(f"[ERROR] build_pr_row crashed: {e}")
             import traceback
             traceback.print_exc()
             return 0
 
-        if batch_df is None or len(batch_df) == 0:
-            print(f"[ERROR] build_initial_pr_dataframe returned empty/None!")
+        if not rows:
+            print(f"[ERROR] No rows to save!")
             return 0
 
-        if len(batch_df) != len(df_rows):
-            print(f"[WARNING] Row mismatch: {len(df_rows)} input → {len(batch_df)} output")
-
-        # Ensure all columns exist
-        for col in COLUMNS:
-            if col not in batch_df.columns:
-                batch_df[col] = None
-
-        batch_df = batch_df[COLUMNS]
+        # Write a NEW Parquet file with the fixed schema; nested list columns
+        # are stored natively instead of JSON-escaped into CSV cells
+        table = pa.Table.from_pylist(rows, schema=SCHEMA)
+        with write_lock:
+            pq.write_table(table, parquet_path)
 
-        # Write to NEW CSV file
-        with csv_lock:
-            batch_df.to_csv(csv_path, mode='w', header=True, index=False)
-
-        # Verify
-        if os.path.exists(csv_path):
-            verify_df = pd.read_csv(csv_path)
-            rows_saved = len(verify_df)
-            print(f"[SAVE] Created {os.path.basename(csv_path)} with {rows_saved} rows")
-            return rows_saved
-        else:
-            print(f"[ERROR] File was not created: {csv_path}")
-            return 0
+        # Verification is a metadata read, not a full re-parse of the file
+        rows_saved = pq.read_metadata(parquet_path).num_rows
+        print(f"[SAVE] Created {os.path.basename(parquet_path)} with {rows_saved} rows")
+        return rows_saved
 
     except Exception as e:
-        print(f"[ERROR] _save_batch_to_separate_csv crashed: {e}")
+        print(f"[ERROR] _save_batch_to_separate_parquet crashed: {e}")
         import traceback
         traceback.print_exc()
         return 0
@@ -272,6 +378,29 @@ def _has_python_files(pr_dict):
     return False
 
 
+def _compress_pr_numbers(pr_numbers):
+    """Compress a set of PR numbers into sorted [lo, hi] ranges.
+
+    Processed PR numbers are mostly contiguous, so a few dozen ranges
+    replace thousands of individual entries in metadata.json.
+    """
+    ranges = []
+    for n in sorted(pr_numbers):
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ranges
+
+
+def _expand_pr_ranges(ranges):
+    """Expand [lo, hi] ranges back into a set of PR numbers."""
+    pr_numbers = set()
+    for lo, hi in ranges:
+        pr_numbers.update(range(lo, hi + 1))
+    return pr_numbers
+
+
 def _load_metadata(metadata_file):
     """Load metadata JSON."""
     if os.path.exists(metadata_file):
@@ -287,7 +416,7 @@ def _save_metadata(metadata_file, metadata):
     """Save metadata JSON."""
     try:
         with open(metadata_file, "w") as f:
-            json.dump(metadata, f, indent=2)
+            json.dump(metadata, f, separators=(',', ':'))
     except Exception as e:
         print(f"[WARNING] Could not save metadata: {e}")
 